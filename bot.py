@@ -1,19 +1,37 @@
 import logging
+import logging.handlers
 import sqlite3
 import time
 import os
-import requests
 import threading
 import uuid
+import zlib
+import gzip
+import shutil
+import glob
 import base64
+import hashlib
+import heapq
 import json
 import asyncio
+import aiohttp
+import atexit
+import contextvars
+import queue
+import random
+import functools
+import contextlib
+import sys
+import traceback
+from collections import Counter, OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor
 from aiohttp import web
 from telegram import Update, LabeledPrice, ReplyKeyboardMarkup, InlineKeyboardButton, InlineKeyboardMarkup
 from telegram.ext import (
     ApplicationBuilder, CommandHandler, MessageHandler, ContextTypes,
-    filters, PreCheckoutQueryHandler, CallbackQueryHandler
+    filters, PreCheckoutQueryHandler, CallbackQueryHandler, TypeHandler
 )
+from telegram.request import HTTPXRequest
 from openai import OpenAI
 from io import BytesIO
 
@@ -24,7 +42,76 @@ try:
 except ImportError:
     YOOKASSA_AVAILABLE = False
 
-logging.basicConfig(format='%(asctime)s - %(name)s - %(levelname)s - %(message)s', level=logging.INFO)
+# --- Логирование ---
+# Хендлеры только кладут запись в очередь, форматирование и запись в поток
+# выполняет фоновый поток QueueListener, чтобы не задерживать event loop
+LOG_FORMAT = os.environ.get("LOG_FORMAT", "json")  # json или text
+LOG_LEVEL = os.environ.get("LOG_LEVEL", "INFO")
+LOG_SAMPLE_RATE = float(os.environ.get("LOG_SAMPLE_RATE", 1.0))  # доля сохраняемых массовых info-логов
+
+# Массовые info-логи помечаются extra=SAMPLED и проходят с вероятностью LOG_SAMPLE_RATE
+SAMPLED = {"sampled": True}
+
+correlation_id = contextvars.ContextVar("correlation_id", default="-")
+
+class CorrelationFilter(logging.Filter):
+    def filter(self, record):
+        record.correlation_id = correlation_id.get()
+        return True
+
+class SamplingFilter(logging.Filter):
+    def __init__(self, rate):
+        super().__init__()
+        self.rate = rate
+
+    def filter(self, record):
+        if getattr(record, "sampled", False) and record.levelno <= logging.INFO:
+            return self.rate >= 1.0 or random.random() < self.rate
+        return True
+
+class JsonFormatter(logging.Formatter):
+    def format(self, record):
+        data = {
+            "ts": self.formatTime(record),
+            "level": record.levelname,
+            "logger": record.name,
+            "cid": getattr(record, "correlation_id", "-"),
+            "msg": record.getMessage(),
+        }
+        if record.exc_info:
+            data["exc"] = self.formatException(record.exc_info)
+        return json.dumps(data, ensure_ascii=False)
+
+class LazyQueueHandler(logging.handlers.QueueHandler):
+    """QueueHandler без форматирования в вызывающем потоке: msg % args собирает слушатель."""
+
+    def prepare(self, record):
+        return record
+
+def setup_logging():
+    log_queue = queue.SimpleQueue()
+    
+    stream_handler = logging.StreamHandler()
+    if LOG_FORMAT == "json":
+        stream_handler.setFormatter(JsonFormatter())
+    else:
+        stream_handler.setFormatter(logging.Formatter(
+            '%(asctime)s - %(name)s - %(levelname)s - [%(correlation_id)s] %(message)s'
+        ))
+    
+    queue_handler = LazyQueueHandler(log_queue)
+    queue_handler.addFilter(SamplingFilter(LOG_SAMPLE_RATE))
+    queue_handler.addFilter(CorrelationFilter())
+    
+    root = logging.getLogger()
+    root.handlers = [queue_handler]
+    root.setLevel(LOG_LEVEL)
+    
+    listener = logging.handlers.QueueListener(log_queue, stream_handler)
+    listener.start()
+    atexit.register(listener.stop)
+
+setup_logging()
 
 # --- Переменные окружения ---
 TELEGRAM_TOKEN = os.environ.get("TELEGRAM_TOKEN")
@@ -43,39 +130,226 @@ if YOOKASSA_AVAILABLE and YOOKASSA_SHOP_ID and YOOKASSA_SECRET_KEY:
     Configuration.account_id = YOOKASSA_SHOP_ID
     Configuration.secret_key = YOOKASSA_SECRET_KEY
 
+PAYMENT_LINK_TTL = int(os.environ.get("PAYMENT_LINK_TTL", 900))  # сек, в течение которых переиспользуем ссылку на оплату
+YOOKASSA_TIMEOUT = float(os.environ.get("YOOKASSA_TIMEOUT", 15))  # таймаут вызова SDK ЮКассы, сек
+YOOKASSA_MAX_WORKERS = int(os.environ.get("YOOKASSA_MAX_WORKERS", 4))  # потоков для вызовов SDK ЮКассы
+
+# SDK ЮКассы синхронный, поэтому его вызовы уходят в отдельный ограниченный пул потоков
+yookassa_executor = ThreadPoolExecutor(max_workers=YOOKASSA_MAX_WORKERS, thread_name_prefix="yookassa")
+
+FLOOD_WINDOW = int(os.environ.get("FLOOD_WINDOW", 60))  # окно антифлуда, сек
+FLOOD_LIMIT_FREE = int(os.environ.get("FLOOD_LIMIT_FREE", 5))  # запросов за окно без подписки
+FLOOD_LIMIT_SUBSCRIBED = int(os.environ.get("FLOOD_LIMIT_SUBSCRIBED", 20))  # запросов за окно с подпиской
+FLOOD_MAX_USERS = int(os.environ.get("FLOOD_MAX_USERS", 10000))  # сколько пользователей держим в памяти
+FLOOD_IDLE_TTL = int(os.environ.get("FLOOD_IDLE_TTL", 600))  # через сколько секунд простоя забываем пользователя
+
+ALBUM_WAIT = float(os.environ.get("ALBUM_WAIT", 1.5))  # сколько ждем остальные фото альбома, сек
+ALBUM_MAX_PHOTOS = 10  # Telegram не присылает в альбоме больше 10 вложений
+
+VISION_CACHE_SIZE = int(os.environ.get("VISION_CACHE_SIZE", 1000))  # ответов Vision в памяти
+VISION_CACHE_MAX_ROWS = int(os.environ.get("VISION_CACHE_MAX_ROWS", 20000))  # ответов Vision в базе
+VISION_CACHE_TTL = int(os.environ.get("VISION_CACHE_TTL", 7 * 24 * 3600))  # время жизни ответа, сек
+GPT4O_INPUT_PRICE = float(os.environ.get("GPT4O_INPUT_PRICE", 2.50))  # $ за 1M входных токенов
+GPT4O_OUTPUT_PRICE = float(os.environ.get("GPT4O_OUTPUT_PRICE", 10.00))  # $ за 1M выходных токенов
+
+PROFILE_INTERVAL = float(os.environ.get("PROFILE_INTERVAL", 0.005))  # шаг сэмплирования профайлера, сек
+PROFILE_MAX_SECONDS = 120  # максимальная длительность /admin_profile
+STALL_THRESHOLD_MS = int(os.environ.get("STALL_THRESHOLD_MS", 300))  # порог зависания event loop по умолчанию, мс
+STALL_CHECK_INTERVAL = 0.05  # как часто сторожевой поток проверяет event loop, сек
+
+ARCHIVE_AFTER_DAYS = int(os.environ.get("ARCHIVE_AFTER_DAYS", 30))  # через сколько дней неактивности архивируем историю
+MAINTENANCE_INTERVAL = int(os.environ.get("MAINTENANCE_INTERVAL", 3600))  # период обслуживания базы, сек
+MAINTENANCE_BATCH = 200  # пользователей за один шаг архивации
+MAINTENANCE_STEP_BUDGET = 0.05  # максимальная длительность одного шага, сек
+MAINTENANCE_PAUSE = 0.2  # пауза между шагами, сек
+VACUUM_PAGES_PER_STEP = 256  # страниц за один шаг incremental_vacuum
+
+BACKUP_DIR = os.environ.get("BACKUP_DIR", "backups")
+BACKUP_INTERVAL = int(os.environ.get("BACKUP_INTERVAL", 24 * 3600))  # период автоматических бэкапов, сек; 0 — выключены
+BACKUP_KEEP = int(os.environ.get("BACKUP_KEEP", 7))  # сколько последних снимков храним
+BACKUP_PAGES_PER_STEP = 64  # страниц базы за один шаг backup API
+BACKUP_STEP_PAUSE = 0.02  # пауза между шагами бэкапа и пачками экспорта, сек
+BACKUP_MAX_RESTARTS = 5  # сколько раз бэкап может начаться заново из-за записи извне, прежде чем сдаться
+EXPORT_BATCH = 500  # строк за один запрос при экспорте
+
+REMINDER_DAYS_BEFORE = int(os.environ.get("REMINDER_DAYS_BEFORE", 3))  # за сколько дней напоминать об окончании подписки
+EXPIRED_NOTICE_GRACE = 24 * 3600  # при запуске уведомляем только о подписках, истекших за последние сутки
+NOTIFY_BATCH_SIZE = 20  # уведомлений в одной пачке
+NOTIFY_BATCH_PAUSE = 1.0  # пауза между пачками, сек (лимит Telegram ~30 сообщений в секунду)
+
 ADMIN_ID = os.environ.get("ADMIN_ID") # ID администратора
 ADMIN_USERNAME = "@adam0v_0" # Username администратора
 
+BOTS_CONFIG = os.environ.get("BOTS_CONFIG")  # JSON-файл со списком ботов; без него работает один бот из TELEGRAM_TOKEN
+PORT = int(os.environ.get("PORT", 5000))
+LLM_MAX_CONCURRENCY = int(os.environ.get("LLM_MAX_CONCURRENCY", 16))  # одновременных запросов к OpenAI на весь процесс
+TELEGRAM_POOL_SIZE = int(os.environ.get("TELEGRAM_POOL_SIZE", 256))  # соединений к Bot API на все боты
+
 # Initialize OpenAI client
 openai_client = OpenAI(api_key=OPENAI_API_KEY)
 
+# Клиент OpenAI синхронный: запросы всех ботов идут через общий ограниченный пул потоков
+llm_executor = ThreadPoolExecutor(max_workers=LLM_MAX_CONCURRENCY, thread_name_prefix="llm")
+
+async def run_llm(func, **kwargs):
+    """Выполняет блокирующий вызов OpenAI в общем пуле, не занимая event loop."""
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(llm_executor, functools.partial(func, **kwargs))
+
 # --- База ---
-conn = sqlite3.connect("user_contexts.db", check_same_thread=False)
-cursor = conn.cursor()
-cursor.execute("""
-CREATE TABLE IF NOT EXISTS contexts (
-    user_id TEXT PRIMARY KEY,
-    role TEXT,
-    history TEXT,
-    free_requests INTEGER,
-    subscription_end REAL
-)
-""")
-
-# Таблица для хранения платежей YooKassa
-cursor.execute("""
-CREATE TABLE IF NOT EXISTS yookassa_payments (
-    payment_id TEXT PRIMARY KEY,
-    user_id TEXT,
-    amount REAL,
-    status TEXT,
-    created_at REAL
-)
-""")
-conn.commit()
+DB_PATH = "user_contexts.db"
+DEFAULT_ROLE = "Ты ассистент, который отвечает коротко и логично. Важно: никогда не используй LaTeX формулы (\\[ \\] или $ $). Пиши математические формулы простым текстом с Unicode символами: √ для корня, ² ³ для степеней, × для умножения, ÷ для деления, ≈ для приблизительно. Пример: v = √(50² + 15²) = √(2500 + 225) = √2725 ≈ 52.2 м/с"
+
+def ensure_column(db_cursor, table, column, definition):
+    db_cursor.execute(f"PRAGMA table_info({table})")
+    if column not in [row[1] for row in db_cursor.fetchall()]:
+        db_cursor.execute(f"ALTER TABLE {table} ADD COLUMN {column} {definition}")
+
+def init_db(db_path):
+    """Открывает базу бота и приводит схему к актуальной."""
+    db_conn = sqlite3.connect(db_path, check_same_thread=False)
+    db_cursor = db_conn.cursor()
+    db_cursor.execute("""
+    CREATE TABLE IF NOT EXISTS contexts (
+        user_id TEXT PRIMARY KEY,
+        role TEXT,
+        history TEXT,
+        free_requests INTEGER,
+        subscription_end REAL
+    )
+    """)
+
+    # Таблица для хранения платежей YooKassa
+    db_cursor.execute("""
+    CREATE TABLE IF NOT EXISTS yookassa_payments (
+        payment_id TEXT PRIMARY KEY,
+        user_id TEXT,
+        amount REAL,
+        status TEXT,
+        created_at REAL
+    )
+    """)
+
+    # Тариф и ссылка нужны, чтобы не создавать повторный платеж при двойном нажатии
+    ensure_column(db_cursor, "yookassa_payments", "months", "INTEGER")
+    ensure_column(db_cursor, "yookassa_payments", "confirmation_url", "TEXT")
+    ensure_column(db_cursor, "yookassa_payments", "idempotence_key", "TEXT")
+    db_cursor.execute(
+        "CREATE INDEX IF NOT EXISTS idx_yookassa_payments_user ON yookassa_payments (user_id, status, created_at)"
+    )
+
+    # Кэш ответов Vision: одинаковые фото пересылаются между пользователями
+    db_cursor.execute("""
+    CREATE TABLE IF NOT EXISTS vision_cache (
+        cache_key TEXT PRIMARY KEY,
+        answer TEXT,
+        cost REAL,
+        created_at REAL,
+        last_used REAL
+    )
+    """)
+    db_cursor.execute("CREATE INDEX IF NOT EXISTS idx_vision_cache_last_used ON vision_cache (last_used)")
+
+    # История неактивных пользователей переезжает в архив в сжатом виде,
+    # в contexts у них остается history = NULL
+    ensure_column(db_cursor, "contexts", "last_active", "REAL")
+    db_cursor.execute("UPDATE contexts SET last_active = ? WHERE last_active IS NULL", (time.time(),))
+    db_cursor.execute("CREATE INDEX IF NOT EXISTS idx_contexts_last_active ON contexts (last_active)")
+    db_cursor.execute("""
+    CREATE TABLE IF NOT EXISTS contexts_archive (
+        user_id TEXT PRIMARY KEY,
+        history BLOB,
+        archived_at REAL
+    )
+    """)
+
+    # Индекс для загрузки планировщика напоминаний без полного прохода по таблице
+    db_cursor.execute("CREATE INDEX IF NOT EXISTS idx_contexts_subscription_end ON contexts (subscription_end)")
+    db_cursor.execute("""
+    CREATE TABLE IF NOT EXISTS subscription_notices (
+        user_id TEXT,
+        kind TEXT,
+        subscription_end REAL,
+        sent_at REAL,
+        PRIMARY KEY (user_id, kind, subscription_end)
+    )
+    """)
+    db_conn.commit()
+
+    # incremental_vacuum работает только в режиме auto_vacuum = INCREMENTAL;
+    # существующую базу переводим в него однократным VACUUM при запуске
+    db_cursor.execute("PRAGMA auto_vacuum")
+    if db_cursor.fetchone()[0] != 2:
+        db_cursor.execute("PRAGMA auto_vacuum = INCREMENTAL")
+        db_cursor.execute("VACUUM")
+    
+    return db_conn
+
+# --- Боты ---
+# Один процесс может обслуживать несколько ботов. У каждого свой токен, база,
+# тарифы и промпт; OpenAI, пулы потоков и HTTP-сервер общие. Бот, к которому
+# относится текущий апдейт или фоновая задача, лежит в current_tenant
+current_tenant = contextvars.ContextVar("current_tenant")
+
+class Tenant:
+    def __init__(self, name, token, db_path, plans=None, default_role=None, return_url=None):
+        self.name = name
+        self.token = token
+        self.db_path = db_path
+        self.plans = plans or SUBSCRIPTION_PLANS
+        self.default_role = default_role or DEFAULT_ROLE
+        self.return_url = return_url or "https://t.me/smaart_chatbot"
+        self.conn = init_db(db_path)
+        self.cursor = self.conn.cursor()
+        self.flood_limiter = FloodLimiter(FLOOD_WINDOW, FLOOD_LIMIT_FREE, FLOOD_LIMIT_SUBSCRIBED, FLOOD_MAX_USERS, FLOOD_IDLE_TTL)
+        self.vision_cache = VisionCache(self.conn, VISION_CACHE_SIZE, VISION_CACHE_MAX_ROWS, VISION_CACHE_TTL)
+        self.subscription_scheduler = SubscriptionScheduler(self.conn)
+        self.backup_lock = asyncio.Lock()
+        self.bot = None
+
+def load_tenants():
+    """
+    Читает список ботов из BOTS_CONFIG, например:
+    [{"name": "main", "token_env": "TELEGRAM_TOKEN", "db": "user_contexts.db"},
+     {"name": "math", "token_env": "MATH_BOT_TOKEN", "db": "math.db", "default_role": "...",
+      "plans": {"sub_1": {"months": 1, "amount": "50.00", "label": "1 месяц"}}}]
+    Без BOTS_CONFIG — один бот "main" с TELEGRAM_TOKEN и user_contexts.db.
+    """
+    if not BOTS_CONFIG:
+        return {"main": Tenant("main", TELEGRAM_TOKEN, DB_PATH)}
+    
+    with open(BOTS_CONFIG, encoding="utf-8") as f:
+        config = json.load(f)
+    
+    tenants = {}
+    for item in config:
+        token = item.get("token") or os.environ.get(item.get("token_env", ""))
+        tenants[item["name"]] = Tenant(
+            item["name"],
+            token,
+            item.get("db", f"{item['name']}.db"),
+            plans=item.get("plans"),
+            default_role=item.get("default_role"),
+            return_url=item.get("return_url")
+        )
+    return tenants
 
-# --- Глобальная переменная для Telegram бота ---
-telegram_bot = None
+tenants = {}
+
+class SharedHTTPXRequest(HTTPXRequest):
+    """
+    Пул соединений к Bot API, общий для всех ботов. Каждый бот вызывает shutdown()
+    при своей остановке, поэтому здесь он ничего не делает, а пул закрывает
+    run_bot через close() после остановки всех ботов.
+    """
+
+    async def shutdown(self):
+        pass
+
+    async def close(self):
+        await super().shutdown()
+
+http_session = None  # общая aiohttp-сессия для прочих HTTP-запросов (картинки OpenAI и т.п.)
 
 # --- Умный выбор модели ---
 def choose_model(text: str) -> str:
@@ -105,14 +379,272 @@ def choose_model(text: str) -> str:
     
     return "gpt-4o-mini"
 
+# --- Антифлуд ---
+class _FloodEntry:
+    __slots__ = ("hits", "subscription_end", "last_seen", "throttled_at")
+
+    def __init__(self, maxlen):
+        self.hits = deque(maxlen=maxlen)
+        self.subscription_end = 0
+        self.last_seen = 0.0
+        self.throttled_at = 0.0
+
+class FloodLimiter:
+    """
+    Скользящее окно запросов на пользователя. Работает только в памяти,
+    чтобы отсекать флуд до обращений к базе и OpenAI.
+    Лимит зависит от подписки; простаивающие пользователи вытесняются (LRU).
+    """
+
+    def __init__(self, window, free_limit, subscribed_limit, max_users, idle_ttl):
+        self.window = window
+        self.free_limit = free_limit
+        self.subscribed_limit = subscribed_limit
+        self.max_users = max_users
+        self.idle_ttl = idle_ttl
+        self.users = OrderedDict()
+        self.throttled_total = 0
+
+    def _evict(self, now):
+        while self.users:
+            entry = next(iter(self.users.values()))
+            if len(self.users) <= self.max_users and now - entry.last_seen < self.idle_ttl:
+                break
+            self.users.popitem(last=False)
+
+    def check(self, user_id):
+        """Возвращает (разрешено, нужно_предупредить). Предупреждаем один раз за окно."""
+        now = time.monotonic()
+        entry = self.users.get(user_id)
+        if entry is None:
+            entry = _FloodEntry(max(self.free_limit, self.subscribed_limit))
+            self.users[user_id] = entry
+        else:
+            self.users.move_to_end(user_id)
+        entry.last_seen = now
+        self._evict(now)
+
+        hits = entry.hits
+        while hits and hits[0] <= now - self.window:
+            hits.popleft()
+
+        limit = self.subscribed_limit if entry.subscription_end > time.time() else self.free_limit
+        if len(hits) >= limit:
+            self.throttled_total += 1
+            warn = now - entry.throttled_at >= self.window
+            entry.throttled_at = now
+            return False, warn
+
+        hits.append(now)
+        return True, False
+
+    def set_subscription_end(self, user_id, subscription_end):
+        entry = self.users.get(user_id)
+        if entry is not None:
+            entry.subscription_end = subscription_end
+
+    def throttled_users(self):
+        """Сколько пользователей упиралось в лимит за последнее окно."""
+        since = time.monotonic() - self.window
+        return sum(1 for entry in self.users.values() if entry.throttled_at > since)
+
+async def check_flood(update: Update):
+    allowed, warn = current_tenant.get().flood_limiter.check(str(update.message.from_user.id))
+    if not allowed and warn:
+        await update.message.reply_text("⏳ Слишком много запросов. Подождите минуту и попробуйте снова.")
+    return allowed
+
+# --- Кэш ответов Vision ---
+class VisionCache:
+    """
+    Ответы Vision по ключу из file_unique_id фото и подписи.
+    Горячие записи живут в памяти (LRU + TTL), остальные — в таблице vision_cache,
+    размер которой ограничен VISION_CACHE_MAX_ROWS.
+    """
+
+    TRIM_EVERY = 100  # как часто подрезаем таблицу, в сохранениях
+
+    def __init__(self, db_conn, size, max_rows, ttl):
+        self.db_conn = db_conn
+        self.size = size
+        self.max_rows = max_rows
+        self.ttl = ttl
+        self.entries = OrderedDict()  # key -> (answer, cost, created_at)
+        self.hits = 0
+        self.misses = 0
+        self.saved = 0.0
+        self.stores = 0
+
+    @staticmethod
+    def make_key(role, file_unique_ids, caption):
+        normalized_caption = " ".join(caption.lower().split())
+        raw = "\n".join([role, ",".join(file_unique_ids), normalized_caption])
+        return hashlib.sha256(raw.encode("utf-8")).hexdigest()
+
+    def _remember(self, key, entry):
+        self.entries[key] = entry
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.size:
+            self.entries.popitem(last=False)
+
+    def get(self, key):
+        now = time.time()
+        entry = self.entries.get(key)
+        if entry is not None and now - entry[2] >= self.ttl:
+            del self.entries[key]
+            entry = None
+        if entry is not None:
+            self.entries.move_to_end(key)
+        else:
+            db_cursor = self.db_conn.cursor()
+            db_cursor.execute(
+                "SELECT answer, cost, created_at FROM vision_cache WHERE cache_key = ? AND created_at > ?",
+                (key, now - self.ttl)
+            )
+            entry = db_cursor.fetchone()
+            if entry is None:
+                self.misses += 1
+                return None
+            db_cursor.execute("UPDATE vision_cache SET last_used = ? WHERE cache_key = ?", (now, key))
+            self.db_conn.commit()
+            self._remember(key, entry)
+
+        self.hits += 1
+        self.saved += entry[1]
+        return entry[0]
+
+    def put(self, key, answer, cost):
+        now = time.time()
+        self._remember(key, (answer, cost, now))
+        db_cursor = self.db_conn.cursor()
+        db_cursor.execute(
+            "INSERT OR REPLACE INTO vision_cache VALUES (?, ?, ?, ?, ?)",
+            (key, answer, cost, now, now)
+        )
+        self.stores += 1
+        if self.stores % self.TRIM_EVERY == 0:
+            db_cursor.execute("DELETE FROM vision_cache WHERE created_at <= ?", (now - self.ttl,))
+            db_cursor.execute(
+                "DELETE FROM vision_cache WHERE cache_key IN ("
+                "SELECT cache_key FROM vision_cache ORDER BY last_used "
+                "LIMIT max(0, (SELECT COUNT(*) FROM vision_cache) - ?))",
+                (self.max_rows,)
+            )
+        self.db_conn.commit()
+
+    def hit_rate(self):
+        total = self.hits + self.misses
+        return self.hits / total * 100 if total else 0.0
+
+def estimate_vision_cost(usage):
+    """Стоимость запроса к gpt-4o в долларах по данным usage из ответа."""
+    if usage is None:
+        return 0.0
+    return (usage.prompt_tokens * GPT4O_INPUT_PRICE + usage.completion_tokens * GPT4O_OUTPUT_PRICE) / 1_000_000
+
+# --- Профилирование и поиск зависаний event loop ---
+# Оба инструмента включаются только админ-командами; в выключенном состоянии
+# у них нет ни потоков, ни задач
+def collapse_stack(frame):
+    """Стек кадра в формате flamegraph: от корня к вершине через ';'."""
+    names = []
+    while frame is not None:
+        code = frame.f_code
+        names.append(f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})")
+        frame = frame.f_back
+    return ";".join(reversed(names))
+
+class SamplingProfiler:
+    def __init__(self, interval):
+        self.interval = interval
+        self.running = False
+
+    def run(self, seconds):
+        """Блокирующий сбор сэмплов всех потоков; вызывать из отдельного потока."""
+        counts = Counter()
+        own_id = threading.get_ident()
+        deadline = time.monotonic() + seconds
+        while time.monotonic() < deadline:
+            thread_names = {t.ident: t.name for t in threading.enumerate()}
+            for thread_id, frame in sys._current_frames().items():
+                if thread_id == own_id:
+                    continue
+                thread_name = thread_names.get(thread_id, str(thread_id))
+                counts[f"{thread_name};{collapse_stack(frame)}"] += 1
+            time.sleep(self.interval)
+        return "\n".join(f"{stack} {count}" for stack, count in counts.most_common())
+
+class StallDetector:
+    """
+    Event loop раз в STALL_CHECK_INTERVAL обновляет отметку времени, сторожевой поток
+    следит за ней. Если отметка устарела больше чем на порог, сохраняется стек
+    потока event loop — то, что его блокирует.
+    """
+
+    def __init__(self, threshold_ms, max_reports=20):
+        self.threshold = threshold_ms / 1000
+        self.enabled = False
+        self.last_beat = 0.0
+        self.loop_thread_id = None
+        self.generation = 0  # отличает текущий запуск от потоков прошлого включения
+        self.stalls = deque(maxlen=max_reports)
+
+    def start(self, threshold_ms=None):
+        if threshold_ms is not None:
+            self.threshold = threshold_ms / 1000
+        if self.enabled:
+            return
+        self.enabled = True
+        self.generation += 1
+        self.last_beat = time.monotonic()
+        self.loop_thread_id = threading.get_ident()
+        asyncio.create_task(self._heartbeat(self.generation))
+        threading.Thread(target=self._watch, args=(self.generation,), name="stall-detector", daemon=True).start()
+
+    def stop(self):
+        self.enabled = False
+
+    def _active(self, generation):
+        return self.enabled and generation == self.generation
+
+    async def _heartbeat(self, generation):
+        while self._active(generation):
+            self.last_beat = time.monotonic()
+            await asyncio.sleep(STALL_CHECK_INTERVAL)
+
+    def _watch(self, generation):
+        current_beat = None
+        current_stall = None
+        while self._active(generation):
+            time.sleep(STALL_CHECK_INTERVAL)
+            beat = self.last_beat
+            lag = time.monotonic() - beat - STALL_CHECK_INTERVAL
+            if beat == current_beat:
+                current_stall["duration"] = lag
+                continue
+            if lag > self.threshold:
+                frame = sys._current_frames().get(self.loop_thread_id)
+                current_beat = beat
+                current_stall = {
+                    "at": time.time(),
+                    "duration": lag,
+                    "stack": "".join(traceback.format_stack(frame)) if frame else "стек недоступен",
+                }
+                self.stalls.append(current_stall)
+                logging.warning("Event loop stalled for more than %.0f ms", lag * 1000)
+
+profiler = SamplingProfiler(PROFILE_INTERVAL)
+stall_detector = StallDetector(STALL_THRESHOLD_MS)
+
 # --- Webhook handlers (aiohttp) ---
 async def handle_health(request):
     return web.json_response({"status": "running", "bot": "active"})
 
 async def handle_yookassa_webhook(request):
+    correlation_id.set(f"webhook-{uuid.uuid4().hex[:8]}")
     try:
         data = await request.json()
-        logging.info(f"Webhook received: {data.get('event') if data else 'no data'}")
+        logging.info("Webhook received: %s", data.get('event') if data else 'no data', extra=SAMPLED)
         
         if data and data.get('event') == 'payment.succeeded':
             payment_obj = data.get('object', {})
@@ -121,64 +653,50 @@ async def handle_yookassa_webhook(request):
             user_id = metadata.get('user_id')
             months = int(metadata.get('months', 1))
             
-            logging.info(f"Processing payment {payment_id} for user {user_id}, months: {months}")
+            logging.info("Processing payment %s for user %s, months: %s", payment_id, user_id, months)
+            
+            # Магазин ЮКассы общий для всех ботов: бот берем из адреса вебхука или из metadata платежа
+            tenant_name = request.match_info.get("tenant") or metadata.get("tenant")
+            tenant = tenants.get(tenant_name) if tenant_name else next(iter(tenants.values()))
+            if tenant is None:
+                logging.error("Webhook for unknown bot %s", tenant_name)
+                return web.json_response({"status": "ok"})
+            current_tenant.set(tenant)
             
             if user_id:
                 days = months * 30
                 
-                webhook_conn = sqlite3.connect("user_contexts.db")
-                webhook_cursor = webhook_conn.cursor()
+                # Пишем через основное соединение бота: запись из другого соединения перезапускает идущий бэкап
+                webhook_cursor = tenant.conn.cursor()
                 
                 try:
-                    webhook_cursor.execute(
-                        "SELECT role, history, free_requests, subscription_end FROM contexts WHERE user_id=?", 
-                        (user_id,)
-                    )
-                    row = webhook_cursor.fetchone()
-                    
-                    if row:
-                        role, history, free_requests, current_sub_end = row
-                    else:
-                        default_role = "Ты ассистент, который отвечает коротко и логично."
-                        role, history, free_requests, current_sub_end = default_role, "[]", 10, 0
-                    
-                    if current_sub_end > time.time():
-                        subscription_end = current_sub_end + days * 24 * 3600
-                    else:
-                        subscription_end = time.time() + days * 24 * 3600
-                    
-                    webhook_cursor.execute(
-                        "INSERT OR REPLACE INTO contexts VALUES (?,?,?,?,?)",
-                        (user_id, role, history, free_requests, subscription_end)
-                    )
+                    extend_subscription(webhook_cursor, user_id, days)
                     
                     webhook_cursor.execute(
                         "UPDATE yookassa_payments SET status = ? WHERE payment_id = ?",
                         ("succeeded", payment_id)
                     )
-                    webhook_conn.commit()
+                    tenant.conn.commit()
                     
-                    logging.info(f"Webhook: Subscription activated for user {user_id} for {days} days")
+                    logging.info("Webhook: Subscription activated for user %s for %s days", user_id, days)
                     
-                    if telegram_bot:
+                    if tenant.bot:
                         try:
-                            await telegram_bot.send_message(
+                            await tenant.bot.send_message(
                                 chat_id=int(user_id),
                                 text=f"✅ Оплата получена! Подписка активирована на {days} дней."
                             )
-                            logging.info(f"Notification sent to user {user_id}")
+                            logging.info("Notification sent to user %s", user_id)
                         except Exception as e:
-                            logging.error(f"Failed to send notification to {user_id}: {e}")
+                            logging.error("Failed to send notification to %s: %s", user_id, e)
                 
                 except Exception as db_error:
-                    logging.error(f"Database error in webhook: {db_error}")
-                finally:
-                    webhook_conn.close()
+                    logging.error("Database error in webhook: %s", db_error)
         
         return web.json_response({"status": "ok"})
         
     except Exception as e:
-        logging.error(f"Webhook error: {e}")
+        logging.error("Webhook error: %s", e)
         return web.json_response({"status": "ok"})
 
 def get_main_menu():
@@ -195,33 +713,121 @@ def get_payment_menu():
     ]
     return InlineKeyboardMarkup(keyboard)
 
+def rehydrate_history(user_id):
+    """Возвращает историю пользователя из архива обратно в contexts."""
+    tenant = current_tenant.get()
+    tenant.cursor.execute("SELECT history FROM contexts_archive WHERE user_id=?", (user_id,))
+    row = tenant.cursor.fetchone()
+    history = zlib.decompress(row[0]).decode("utf-8") if row else str([])
+    # last_active обновляем сразу, иначе обслуживание снова заархивирует пользователя
+    tenant.cursor.execute(
+        "UPDATE contexts SET history=?, last_active=? WHERE user_id=?", (history, time.time(), user_id)
+    )
+    tenant.cursor.execute("DELETE FROM contexts_archive WHERE user_id=?", (user_id,))
+    tenant.conn.commit()
+    return history
+
 def get_user_context(user_id):
-    cursor.execute("SELECT role, history, free_requests, subscription_end FROM contexts WHERE user_id=?", (user_id,))
-    row = cursor.fetchone()
+    tenant = current_tenant.get()
+    tenant.cursor.execute("SELECT role, history, free_requests, subscription_end FROM contexts WHERE user_id=?", (user_id,))
+    row = tenant.cursor.fetchone()
     if row:
         role, history, free_requests, subscription_end = row
+        if history is None:
+            history = rehydrate_history(user_id)
+        tenant.flood_limiter.set_subscription_end(user_id, subscription_end)
         return role, eval(history), free_requests, subscription_end
     else:
-        default_role = "Ты ассистент, который отвечает коротко и логично. Важно: никогда не используй LaTeX формулы (\\[ \\] или $ $). Пиши математические формулы простым текстом с Unicode символами: √ для корня, ² ³ для степеней, × для умножения, ÷ для деления, ≈ для приблизительно. Пример: v = √(50² + 15²) = √(2500 + 225) = √2725 ≈ 52.2 м/с"
-        cursor.execute(
-            "INSERT OR REPLACE INTO contexts VALUES (?,?,?,?,?)",
-            (user_id, default_role, str([]), 10, 0)
+        tenant.cursor.execute(
+            "INSERT OR REPLACE INTO contexts (user_id, role, history, free_requests, subscription_end, last_active) "
+            "VALUES (?,?,?,?,?,?)",
+            (user_id, tenant.default_role, str([]), 10, 0, time.time())
         )
-        conn.commit()
-        return default_role, [], 10, 0
+        tenant.conn.commit()
+        return tenant.default_role, [], 10, 0
 
-def save_user_context(user_id, role, history, free_requests, subscription_end):
-    cursor.execute(
-        "INSERT OR REPLACE INTO contexts VALUES (?,?,?,?,?)",
-        (user_id, role, str(history), free_requests, subscription_end)
+def save_user_context(user_id, role, history):
+    """
+    Сохраняет диалог и списывает один бесплатный запрос. subscription_end не трогает:
+    пока обработчик ждет OpenAI, вебхук или проверка платежей могут продлить подписку.
+    Счетчик уменьшается в самой базе, а не записывается значением, прочитанным до запроса.
+    """
+    tenant = current_tenant.get()
+    tenant.cursor.execute(
+        "UPDATE contexts SET role=?, history=?, last_active=? WHERE user_id=?",
+        (role, str(history), time.time(), user_id)
     )
-    conn.commit()
+    tenant.cursor.execute(
+        "UPDATE contexts SET free_requests = free_requests - 1 WHERE user_id=? AND free_requests > 0",
+        (user_id,)
+    )
+    # если обслуживание успело заархивировать историю во время запроса к OpenAI, копия в архиве устарела
+    tenant.cursor.execute("DELETE FROM contexts_archive WHERE user_id=?", (user_id,))
+    tenant.conn.commit()
+
+def set_subscription_end(user_id, subscription_end):
+    tenant = current_tenant.get()
+    tenant.cursor.execute("UPDATE contexts SET subscription_end=? WHERE user_id=?", (subscription_end, user_id))
+    tenant.conn.commit()
+    tenant.subscription_scheduler.update(user_id, subscription_end)
+
+def extend_subscription(db_cursor, user_id, days):
+    """Продлевает подписку на days дней от текущего окончания или от текущего момента."""
+    tenant = current_tenant.get()
+    db_cursor.execute("SELECT subscription_end FROM contexts WHERE user_id=?", (user_id,))
+    row = db_cursor.fetchone()
+    current_sub_end = row[0] if row else 0
+    
+    if current_sub_end > time.time():
+        subscription_end = current_sub_end + days * 24 * 3600
+    else:
+        subscription_end = time.time() + days * 24 * 3600
+    
+    if row:
+        db_cursor.execute("UPDATE contexts SET subscription_end=? WHERE user_id=?", (subscription_end, user_id))
+    else:
+        db_cursor.execute(
+            "INSERT INTO contexts (user_id, role, history, free_requests, subscription_end, last_active) "
+            "VALUES (?,?,?,?,?,?)",
+            (user_id, tenant.default_role, str([]), 10, subscription_end, time.time())
+        )
+    tenant.subscription_scheduler.update(user_id, subscription_end)
+    return subscription_end
 
 def has_access(user_id):
     _, _, free_requests, subscription_end = get_user_context(user_id)
     return free_requests > 0 or subscription_end > time.time()
 
+user_locks = {}  # (бот, пользователь) -> [asyncio.Lock, сколько корутин его ждут или держат]
+
+@contextlib.asynccontextmanager
+async def user_lock(user_id):
+    """
+    Запросы одного пользователя к ИИ идут по очереди: альбомы обрабатываются вне
+    последовательной очереди PTB, и без лока проверка доступа → запрос → сохранение
+    разных сообщений перемешивались бы.
+    """
+    key = (current_tenant.get().name, user_id)
+    entry = user_locks.get(key)
+    if entry is None:
+        entry = user_locks[key] = [asyncio.Lock(), 0]
+    entry[1] += 1
+    try:
+        async with entry[0]:
+            yield
+    finally:
+        entry[1] -= 1
+        if entry[1] == 0:
+            user_locks.pop(key, None)
+
 # --- Команды ---
+async def bind_update_context(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    # Выполняется первым для каждого апдейта: все логи его обработки получают один ID,
+    # а обработчики работают с базой и настройками своего бота
+    tenant = context.bot_data["tenant"]
+    current_tenant.set(tenant)
+    correlation_id.set(f"{tenant.name}-update-{update.update_id}")
+
 async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
     await update.message.reply_text(
         "👋 Привет! Я твой AI-помощник на базе GPT-4o.\n\n"
@@ -274,9 +880,8 @@ async def help_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
 async def subscribe_menu(update: Update, context: ContextTypes.DEFAULT_TYPE):
     keyboard = [
-        [InlineKeyboardButton("1 месяц — 30₽", callback_data="sub_1")],
-        [InlineKeyboardButton("3 месяца — 80₽", callback_data="sub_3")],
-        [InlineKeyboardButton("6 месяцев — 160₽", callback_data="sub_6")]
+        [InlineKeyboardButton(f"{plan['label']} — {float(plan['amount']):g}₽", callback_data=plan_id)]
+        for plan_id, plan in current_tenant.get().plans.items()
     ]
     await update.message.reply_text(
         "💳 Выберите срок подписки:",
@@ -293,8 +898,9 @@ async def button_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
     query = update.callback_query
     await query.answer()
     
-    if query.data in SUBSCRIPTION_PLANS:
-        plan = SUBSCRIPTION_PLANS[query.data]
+    plans = current_tenant.get().plans
+    if query.data in plans:
+        plan = plans[query.data]
         await pay_yookassa(update, context, plan["amount"], plan["months"], plan["label"])
     elif query.data == "pay_yookassa":
         await pay_yookassa(update, context, "30.00", 1, "1 месяц")
@@ -321,30 +927,160 @@ async def admin_stats(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if str(user.id) != ADMIN_ID and user.username != "adam0v_0":
         return
     
-    cursor.execute("SELECT COUNT(*) FROM contexts")
-    total_users = cursor.fetchone()[0]
+    tenant = current_tenant.get()
+    
+    tenant.cursor.execute("SELECT COUNT(*) FROM contexts")
+    total_users = tenant.cursor.fetchone()[0]
+    
+    tenant.cursor.execute("SELECT COUNT(*) FROM contexts WHERE subscription_end > ?", (time.time(),))
+    active_subs = tenant.cursor.fetchone()[0]
     
-    cursor.execute("SELECT COUNT(*) FROM contexts WHERE subscription_end > ?", (time.time(),))
-    active_subs = cursor.fetchone()[0]
+    tenant.cursor.execute("SELECT COUNT(*) FROM contexts_archive")
+    archived_users = tenant.cursor.fetchone()[0]
     
     await update.message.reply_text(
-        f"📊 Статистика бота\n\n"
+        f"📊 Статистика бота {tenant.name}\n\n"
         f"Всего пользователей: {total_users}\n"
-        f"Активных подписок: {active_subs}"
+        f"Активных подписок: {active_subs}\n"
+        f"История в архиве: {archived_users}\n\n"
+        f"🚦 Антифлуд\n"
+        f"Ограничено за последние {FLOOD_WINDOW} сек: {tenant.flood_limiter.throttled_users()}\n"
+        f"Отклонено запросов всего: {tenant.flood_limiter.throttled_total}\n\n"
+        f"🖼 Кэш Vision\n"
+        f"Попаданий: {tenant.vision_cache.hits} из {tenant.vision_cache.hits + tenant.vision_cache.misses} ({tenant.vision_cache.hit_rate():.1f}%)\n"
+        f"Сэкономлено: ≈ ${tenant.vision_cache.saved:.2f}"
     )
 
+async def admin_profile(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    user = update.message.from_user
+    if str(user.id) != ADMIN_ID and user.username != "adam0v_0":
+        return
+    
+    seconds = 10
+    if context.args:
+        try:
+            seconds = min(max(int(context.args[0]), 1), PROFILE_MAX_SECONDS)
+        except ValueError:
+            await update.message.reply_text(f"Использование: /admin_profile [секунд, до {PROFILE_MAX_SECONDS}]")
+            return
+    
+    if profiler.running:
+        await update.message.reply_text("Профилирование уже идет, дождитесь результата.")
+        return
+    
+    profiler.running = True
+    await update.message.reply_text(f"⏱ Профилирую {seconds} сек...")
+    try:
+        folded = await asyncio.to_thread(profiler.run, seconds)
+    finally:
+        profiler.running = False
+    
+    await update.message.reply_document(
+        document=BytesIO(folded.encode("utf-8")),
+        filename=f"profile-{time.strftime('%Y%m%d-%H%M%S')}.folded",
+        caption="Сэмплы в формате flamegraph (collapsed stacks): flamegraph.pl или speedscope."
+    )
+
+async def admin_stalls(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    user = update.message.from_user
+    if str(user.id) != ADMIN_ID and user.username != "adam0v_0":
+        return
+    
+    if context.args and context.args[0] == "on":
+        threshold_ms = None
+        if len(context.args) > 1:
+            try:
+                threshold_ms = max(int(context.args[1]), 10)
+            except ValueError:
+                await update.message.reply_text("Использование: /admin_stalls on [порог, мс]")
+                return
+        stall_detector.start(threshold_ms)
+        await update.message.reply_text(f"✅ Детектор зависаний включен, порог {stall_detector.threshold * 1000:.0f} мс.")
+        return
+    
+    if context.args and context.args[0] == "off":
+        stall_detector.stop()
+        await update.message.reply_text("❌ Детектор зависаний выключен.")
+        return
+    
+    status = "включен" if stall_detector.enabled else "выключен"
+    if not stall_detector.stalls:
+        await update.message.reply_text(
+            f"Детектор зависаний {status}. Зависаний не зафиксировано.\n\n"
+            "Использование: /admin_stalls [on [порог, мс] | off]"
+        )
+        return
+    
+    parts = [f"🐢 Зависания event loop (детектор {status}), последние {min(len(stall_detector.stalls), 5)}:"]
+    for stall in list(stall_detector.stalls)[-5:]:
+        when = time.strftime('%d.%m %H:%M:%S', time.localtime(stall["at"]))
+        stack_tail = "".join(stall["stack"].splitlines(keepends=True)[-8:])
+        parts.append(f"{when} — {stall['duration'] * 1000:.0f} мс\n{stack_tail}")
+    await update.message.reply_text("\n\n".join(parts)[-4000:])
+
+async def admin_backup(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    user = update.message.from_user
+    if str(user.id) != ADMIN_ID and user.username != "adam0v_0":
+        return
+    
+    tenant = current_tenant.get()
+    if tenant.backup_lock.locked():
+        await update.message.reply_text("Бэкап, экспорт или обслуживание базы уже выполняется, дождитесь завершения.")
+        return
+    
+    await update.message.reply_text("💾 Создаю снимок базы...")
+    try:
+        async with tenant.backup_lock:
+            backup_path = await asyncio.to_thread(backup_database, tenant)
+    except Exception as e:
+        logging.error("Backup error: %s", e)
+        await update.message.reply_text("Не удалось создать бэкап. Подробности в логах.")
+        return
+    
+    size_mb = os.path.getsize(backup_path) / 1024 / 1024
+    await update.message.reply_text(f"✅ Бэкап готов: {backup_path} ({size_mb:.1f} МБ)")
+
+async def admin_export(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    user = update.message.from_user
+    if str(user.id) != ADMIN_ID and user.username != "adam0v_0":
+        return
+    
+    tenant = current_tenant.get()
+    if tenant.backup_lock.locked():
+        await update.message.reply_text("Бэкап, экспорт или обслуживание базы уже выполняется, дождитесь завершения.")
+        return
+    
+    await update.message.reply_text("📤 Выгружаю пользователей и платежи...")
+    try:
+        async with tenant.backup_lock:
+            export_path, users, payments = await asyncio.to_thread(export_users_and_payments, tenant)
+    except Exception as e:
+        logging.error("Export error: %s", e)
+        await update.message.reply_text("Не удалось выполнить экспорт. Подробности в логах.")
+        return
+    
+    caption = f"Пользователей: {users}, платежей: {payments}"
+    # Боты не могут отправлять файлы больше 50 МБ
+    if os.path.getsize(export_path) < 50 * 1024 * 1024:
+        with open(export_path, "rb") as f:
+            await update.message.reply_document(document=f, filename=os.path.basename(export_path), caption=caption)
+    else:
+        await update.message.reply_text(f"✅ Экспорт готов: {export_path}\n{caption}")
+
 async def admin_broadcast(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user = update.message.from_user
     if str(user.id) != ADMIN_ID and user.username != "adam0v_0":
         return
     
+    tenant = current_tenant.get()
+    
     msg = " ".join(context.args)
     if not msg:
         await update.message.reply_text("Введите текст рассылки после команды.")
         return
     
-    cursor.execute("SELECT user_id FROM contexts")
-    users = cursor.fetchall()
+    tenant.cursor.execute("SELECT user_id FROM contexts")
+    users = tenant.cursor.fetchall()
     
     count = 0
     for user in users:
@@ -353,7 +1089,7 @@ async def admin_broadcast(update: Update, context: ContextTypes.DEFAULT_TYPE):
             await context.bot.send_message(chat_id=user[0], text=msg)
             count += 1
         except Exception as e:
-            logging.error(f"Error sending message to {user[0]}: {e}")
+            logging.error("Error sending message to %s: %s", user[0], e)
             continue
             
     await update.message.reply_text(f"✅ Рассылка завершена. Отправлено {count} пользователям.")
@@ -378,9 +1114,8 @@ async def activate_subscription(update: Update, context: ContextTypes.DEFAULT_TY
             months = 1
     
     days = months * 30
-    role, history, free_requests, _ = get_user_context(target_user_id)
-    subscription_end = time.time() + days * 24 * 3600
-    save_user_context(target_user_id, role, history, free_requests, subscription_end)
+    get_user_context(target_user_id)
+    set_subscription_end(target_user_id, time.time() + days * 24 * 3600)
     
     month_word = "месяц" if months == 1 else ("месяца" if months < 5 else "месяцев")
     await update.message.reply_text(f"✅ Подписка для {target_user_id} активирована на {months} {month_word}.")
@@ -399,8 +1134,8 @@ async def deactivate_subscription(update: Update, context: ContextTypes.DEFAULT_
         return
     
     target_user_id = context.args[0]
-    role, history, free_requests, _ = get_user_context(target_user_id)
-    save_user_context(target_user_id, role, history, free_requests, 0)
+    get_user_context(target_user_id)
+    set_subscription_end(target_user_id, 0)
     
     await update.message.reply_text(f"❌ Подписка для {target_user_id} деактивирована.")
     try:
@@ -439,12 +1174,99 @@ async def precheckout_callback(update: Update, context: ContextTypes.DEFAULT_TYP
 
 async def successful_payment_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user_id = str(update.message.from_user.id)
-    role, history, free_requests, _ = get_user_context(user_id)
-    subscription_end = time.time() + 30*24*3600
-    save_user_context(user_id, role, history, free_requests, subscription_end)
+    get_user_context(user_id)
+    set_subscription_end(user_id, time.time() + 30*24*3600)
     await update.message.reply_text("Оплата через Telegram успешна! Подписка активирована на 30 дней.")
 
 # --- YooKassa платежи ---
+payment_intent_locks = {}  # (бот, пользователь, тариф) -> [asyncio.Lock, сколько корутин его ждут или держат]
+
+async def run_yookassa(func, *args):
+    """Выполняет блокирующий вызов SDK ЮКассы в отдельном пуле потоков с таймаутом."""
+    loop = asyncio.get_running_loop()
+    return await asyncio.wait_for(
+        loop.run_in_executor(yookassa_executor, func, *args),
+        timeout=YOOKASSA_TIMEOUT
+    )
+
+def find_payment_intent(user_id, months):
+    """Ищет свежий неоплаченный платеж пользователя по тому же тарифу."""
+    tenant = current_tenant.get()
+    tenant.cursor.execute(
+        "SELECT payment_id, confirmation_url FROM yookassa_payments "
+        "WHERE user_id = ? AND months = ? AND status = 'pending' AND confirmation_url IS NOT NULL "
+        "AND created_at > ? ORDER BY created_at DESC LIMIT 1",
+        (user_id, months, time.time() - PAYMENT_LINK_TTL)
+    )
+    return tenant.cursor.fetchone()
+
+def payment_idempotence_key(tenant, user_id, months):
+    """
+    Ключ идемпотентности, одинаковый для тарифа пользователя в пределах окна PAYMENT_LINK_TTL.
+    Если Payment.create не уложился в таймаут, но дошел до ЮКассы, повтор вернет тот же платеж.
+    """
+    window = int(time.time() // PAYMENT_LINK_TTL)
+    return str(uuid.uuid5(uuid.NAMESPACE_URL, f"{tenant.name}:{user_id}:{months}:{window}"))
+
+async def get_or_create_payment_intent(user_id, amount, months, label):
+    """
+    Возвращает ссылку на оплату тарифа: существующую, если она моложе PAYMENT_LINK_TTL,
+    или новую. Повторные нажатия одной кнопки ждут первое создание и получают ту же ссылку.
+    """
+    tenant = current_tenant.get()
+    key = (tenant.name, user_id, months)
+    entry = payment_intent_locks.get(key)
+    if entry is None:
+        entry = payment_intent_locks[key] = [asyncio.Lock(), 0]
+    entry[1] += 1
+    try:
+        async with entry[0]:
+            row = find_payment_intent(user_id, months)
+            if row:
+                logging.info("Reusing payment %s for user %s, months: %s", row[0], user_id, months, extra=SAMPLED)
+                return row[1]
+
+            params = {
+                "amount": {
+                    "value": amount,
+                    "currency": "RUB"
+                },
+                "confirmation": {
+                    "type": "redirect",
+                    "return_url": tenant.return_url
+                },
+                "capture": True,
+                "description": f"Подписка на бота ({label}) для пользователя {user_id}",
+                "metadata": {
+                    "user_id": user_id,
+                    "months": months,
+                    "tenant": tenant.name
+                }
+            }
+            idempotence_key = payment_idempotence_key(tenant, user_id, months)
+            payment = await run_yookassa(Payment.create, params, idempotence_key)
+            if payment.status != "pending":
+                # По этому ключу в текущем окне уже был платеж, и он оплачен или отменен
+                idempotence_key = str(uuid.uuid4())
+                payment = await run_yookassa(Payment.create, params, idempotence_key)
+
+            payment_url = payment.confirmation.confirmation_url
+
+            # Сохраняем платеж в базу
+            tenant.cursor.execute(
+                "INSERT OR REPLACE INTO yookassa_payments "
+                "(payment_id, user_id, amount, status, created_at, months, confirmation_url, idempotence_key) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                (payment.id, user_id, float(amount), payment.status, time.time(), months, payment_url, idempotence_key)
+            )
+            tenant.conn.commit()
+            return payment_url
+    finally:
+        # Запись удаляем, только когда лок больше никто не ждет
+        entry[1] -= 1
+        if entry[1] == 0:
+            payment_intent_locks.pop(key, None)
+
 async def pay_yookassa(update: Update, context: ContextTypes.DEFAULT_TYPE, amount: str = "30.00", months: int = 1, label: str = "1 месяц"):
     msg_target = update.message or update.callback_query.message
     user_id = str((update.message or update.callback_query).from_user.id)
@@ -457,47 +1279,28 @@ async def pay_yookassa(update: Update, context: ContextTypes.DEFAULT_TYPE, amoun
         return
     
     try:
-        idempotence_key = str(uuid.uuid4())
-        days = months * 30
-        payment = Payment.create({
-            "amount": {
-                "value": amount,
-                "currency": "RUB"
-            },
-            "confirmation": {
-                "type": "redirect",
-                "return_url": "https://t.me/smaart_chatbot"
-            },
-            "capture": True,
-            "description": f"Подписка на бота ({label}) для пользователя {user_id}",
-            "metadata": {
-                "user_id": user_id,
-                "months": months
-            }
-        }, idempotence_key)
-        
-        # Сохраняем платеж в базу
-        cursor.execute(
-            "INSERT OR REPLACE INTO yookassa_payments VALUES (?, ?, ?, ?, ?)",
-            (payment.id, user_id, 30.0, payment.status, time.time())
-        )
-        conn.commit()
-        
-        payment_url = payment.confirmation.confirmation_url
+        payment_url = await get_or_create_payment_intent(user_id, amount, months, label)
         
         await msg_target.reply_text(
             f"💳 Для оплаты подписки ({label}) перейдите по ссылке:\n\n{payment_url}\n\n"
             "✅ После оплаты подписка активируется автоматически!",
             reply_markup=get_main_menu()
         )
+    except asyncio.TimeoutError:
+        logging.error("YooKassa payment timeout for user %s", user_id)
+        await msg_target.reply_text(
+            "ЮКасса не ответила вовремя. Попробуйте еще раз через минуту.",
+            reply_markup=get_main_menu()
+        )
     except Exception as e:
-        logging.error(f"YooKassa payment error: {e}")
+        logging.error("YooKassa payment error: %s", e)
         await msg_target.reply_text(
             "Произошла ошибка при создании платежа. Попробуйте позже или обратитесь к @adam0v_0.",
             reply_markup=get_main_menu()
         )
 
 async def check_yookassa_payment(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    tenant = current_tenant.get()
     user_id = str(update.message.from_user.id)
     
     if not YOOKASSA_AVAILABLE or not YOOKASSA_SHOP_ID or not YOOKASSA_SECRET_KEY:
@@ -505,11 +1308,11 @@ async def check_yookassa_payment(update: Update, context: ContextTypes.DEFAULT_T
         return
     
     # Получаем последний платеж пользователя
-    cursor.execute(
+    tenant.cursor.execute(
         "SELECT payment_id FROM yookassa_payments WHERE user_id = ? ORDER BY created_at DESC LIMIT 1",
         (user_id,)
     )
-    row = cursor.fetchone()
+    row = tenant.cursor.fetchone()
     
     if not row:
         await update.message.reply_text(
@@ -521,26 +1324,20 @@ async def check_yookassa_payment(update: Update, context: ContextTypes.DEFAULT_T
     payment_id = row[0]
     
     try:
-        payment = Payment.find_one(payment_id)
+        payment = await run_yookassa(Payment.find_one, payment_id)
         
         if payment.status == "succeeded":
             # Платеж успешен - активируем подписку
             months = int(payment.metadata.get("months", 1)) if payment.metadata else 1
             days = months * 30
-            role, history, free_requests, current_sub_end = get_user_context(user_id)
-            
-            if current_sub_end > time.time():
-                subscription_end = current_sub_end + days * 24 * 3600
-            else:
-                subscription_end = time.time() + days * 24 * 3600
+            get_user_context(user_id)
+            extend_subscription(tenant.cursor, user_id, days)
             
-            save_user_context(user_id, role, history, free_requests, subscription_end)
-            
-            cursor.execute(
+            tenant.cursor.execute(
                 "UPDATE yookassa_payments SET status = ? WHERE payment_id = ?",
                 ("succeeded", payment_id)
             )
-            conn.commit()
+            tenant.conn.commit()
             
             await update.message.reply_text(
                 f"✅ Оплата подтверждена! Подписка активирована на {days} дней.",
@@ -562,7 +1359,7 @@ async def check_yookassa_payment(update: Update, context: ContextTypes.DEFAULT_T
                 reply_markup=get_main_menu()
             )
     except Exception as e:
-        logging.error(f"YooKassa check error: {e}")
+        logging.error("YooKassa check error: %s", e)
         await update.message.reply_text(
             "Произошла ошибка при проверке платежа. Попробуйте позже.",
             reply_markup=get_main_menu()
@@ -570,169 +1367,316 @@ async def check_yookassa_payment(update: Update, context: ContextTypes.DEFAULT_T
 
 # --- Генерация текста GPT-3.5 ---
 async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    if not await check_flood(update):
+        return
     user_id = str(update.message.from_user.id)
-    role, history, free_requests, subscription_end = get_user_context(user_id)
-    text = update.message.text
+    async with user_lock(user_id):
+        role, history, free_requests, subscription_end = get_user_context(user_id)
+        text = update.message.text
 
-    if not has_access(user_id):
-        await update.message.reply_text("Первые 10 сообщений закончились. Используй /subscribe для оформления подписки.")
-        return
+        if not has_access(user_id):
+            await update.message.reply_text("Первые 10 сообщений закончились. Используй /subscribe для оформления подписки.")
+            return
 
-    math_instruction = "ВАЖНО: Никогда не используй LaTeX (\\[, \\], $, $$, \\frac, \\sqrt и т.д.). Пиши формулы только простым текстом с Unicode: √ для корня, ² ³ для степеней, × для умножения, ÷ для деления, ≈ для приблизительно равно. Пример правильного ответа: v = √(50² + 15²) = √2725 ≈ 52.2 м/с"
-    system_content = f"{role}\n\n{math_instruction}"
-    messages = [{"role": "system", "content": system_content}] + history + [{"role": "user", "content": text}]
+        math_instruction = "ВАЖНО: Никогда не используй LaTeX (\\[, \\], $, $$, \\frac, \\sqrt и т.д.). Пиши формулы только простым текстом с Unicode: √ для корня, ² ³ для степеней, × для умножения, ÷ для деления, ≈ для приблизительно равно. Пример правильного ответа: v = √(50² + 15²) = √2725 ≈ 52.2 м/с"
+        system_content = f"{role}\n\n{math_instruction}"
+        messages = [{"role": "system", "content": system_content}] + history + [{"role": "user", "content": text}]
     
-    selected_model = choose_model(text)
-    logging.info(f"User {user_id}: using model {selected_model} for message")
+        selected_model = choose_model(text)
+        logging.info("User %s: using model %s for message", user_id, selected_model, extra=SAMPLED)
     
-    try:
-        response = openai_client.chat.completions.create(
-            model=selected_model,
-            messages=messages,
-            temperature=0.7
-        )
-        answer = response.choices[0].message.content
-        
-        # Разбиваем длинные сообщения, если они превышают лимит Telegram (4096 символов)
-        if len(answer) > 4000:
-            for i in range(0, len(answer), 4000):
-                chunk = answer[i:i+4000]
-                if chunk:
-                    await update.message.reply_text(chunk)
-        else:
-            await update.message.reply_text(answer)
-
-        history.append({"role": "user", "content": text})
-        history.append({"role": "assistant", "content": answer})
-        history = history[-20:]
-        if free_requests > 0:
-            free_requests -= 1
-        save_user_context(user_id, role, history, free_requests, subscription_end)
-    except Exception as e:
-        error_msg = str(e)
-        if "insufficient_quota" in error_msg or "429" in error_msg:
-            await update.message.reply_text(
-                "🤖 Извините, сейчас я перегружен или у меня закончились ресурсы для обработки запросов. "
-                "Пожалуйста, попробуйте позже или обратитесь к администратору @adam0v_0.",
-                reply_markup=get_main_menu()
-            )
-        else:
-            await update.message.reply_text(
-                "Произошла ошибка при обработке сообщения. Попробуйте еще раз позже.",
-                reply_markup=get_main_menu()
+        try:
+            response = await run_llm(
+                openai_client.chat.completions.create,
+                model=selected_model,
+                messages=messages,
+                temperature=0.7
             )
+            answer = response.choices[0].message.content
+        
+            # Разбиваем длинные сообщения, если они превышают лимит Telegram (4096 символов)
+            if len(answer) > 4000:
+                for i in range(0, len(answer), 4000):
+                    chunk = answer[i:i+4000]
+                    if chunk:
+                        await update.message.reply_text(chunk)
+            else:
+                await update.message.reply_text(answer)
+
+            history.append({"role": "user", "content": text})
+            history.append({"role": "assistant", "content": answer})
+            history = history[-20:]
+            save_user_context(user_id, role, history)
+        except Exception as e:
+            error_msg = str(e)
+            if "insufficient_quota" in error_msg or "429" in error_msg:
+                await update.message.reply_text(
+                    "🤖 Извините, сейчас я перегружен или у меня закончились ресурсы для обработки запросов. "
+                    "Пожалуйста, попробуйте позже или обратитесь к администратору @adam0v_0.",
+                    reply_markup=get_main_menu()
+                )
+            else:
+                await update.message.reply_text(
+                    "Произошла ошибка при обработке сообщения. Попробуйте еще раз позже.",
+                    reply_markup=get_main_menu()
+                )
 
 # --- Обработка фото с GPT-4o Vision ---
+# Фото из одного альбома приходят отдельными апдейтами: копим их по media_group_id
+# и отправляем в Vision одним запросом
+media_groups = {}
+
 async def handle_photo(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    user_id = str(update.message.from_user.id)
-    role, history, free_requests, subscription_end = get_user_context(user_id)
+    message = update.message
+    media_group_id = message.media_group_id
     
-    if not has_access(user_id):
-        await update.message.reply_text("Первые 10 сообщений закончились. Используй /subscribe для оформления подписки.")
+    if media_group_id:
+        if media_group_id in media_groups:
+            group = media_groups[media_group_id]
+            if group is not None and len(group) < ALBUM_MAX_PHOTOS:
+                group.append(message)
+            return
+        # Альбом считается одним запросом; None — альбом отклонен антифлудом
+        media_groups[media_group_id] = [message] if await check_flood(update) else None
+        context.application.create_task(process_media_group(media_group_id, context))
         return
     
-    caption = update.message.caption or "Что изображено на этом фото? Опиши подробно и помоги с любым заданием, если оно есть."
+    if not await check_flood(update):
+        return
+    await analyze_photos(message, context, [message])
+
+async def process_media_group(media_group_id, context: ContextTypes.DEFAULT_TYPE):
+    await asyncio.sleep(ALBUM_WAIT)
+    messages = media_groups.pop(media_group_id, None)
+    if messages:
+        messages.sort(key=lambda m: m.message_id)
+        await analyze_photos(messages[0], context, messages)
+
+async def download_photo(bot, photo):
+    file = await bot.get_file(photo.file_id)
+    return await file.download_as_bytearray()
+
+async def analyze_photos(message, context: ContextTypes.DEFAULT_TYPE, photo_messages):
+    user_id = str(message.from_user.id)
+    async with user_lock(user_id):
+        role, history, free_requests, subscription_end = get_user_context(user_id)
     
-    try:
-        photo = update.message.photo[-1]
-        file = await context.bot.get_file(photo.file_id)
-        photo_bytes = await file.download_as_bytearray()
-        base64_image = base64.b64encode(photo_bytes).decode('utf-8')
-        
-        await update.message.reply_text("🔍 Анализирую изображение...")
+        if not has_access(user_id):
+            await message.reply_text("Первые 10 сообщений закончились. Используй /subscribe для оформления подписки.")
+            return
+    
+        count = len(photo_messages)
+        caption = next((m.caption for m in photo_messages if m.caption), None)
+        if not caption:
+            if count > 1:
+                caption = "Что изображено на этих фото? Опиши подробно и помоги с любым заданием, если оно есть."
+            else:
+                caption = "Что изображено на этом фото? Опиши подробно и помоги с любым заданием, если оно есть."
+    
+        try:
+            cache_key = VisionCache.make_key(role, [m.photo[-1].file_unique_id for m in photo_messages], caption)
+            vision_cache = current_tenant.get().vision_cache
+            answer = vision_cache.get(cache_key)
         
-        math_instruction = "ВАЖНО: Никогда не используй LaTeX (\\[, \\], $, $$, \\frac, \\sqrt и т.д.). Пиши формулы только простым текстом с Unicode: √ для корня, ² ³ для степеней, × для умножения, ÷ для деления, ≈ для приблизительно равно. Пример правильного ответа: v = √(50² + 15²) = √2725 ≈ 52.2 м/с"
-        system_content = f"{role}\n\n{math_instruction}"
-        messages = [
-            {"role": "system", "content": system_content},
-            {
-                "role": "user",
-                "content": [
-                    {"type": "text", "text": caption},
-                    {
+            if answer is None:
+                photos_bytes = await asyncio.gather(*(download_photo(context.bot, m.photo[-1]) for m in photo_messages))
+            
+                if count > 1:
+                    await message.reply_text(f"🔍 Анализирую изображения ({count} шт.)...")
+                else:
+                    await message.reply_text("🔍 Анализирую изображение...")
+            
+                content = [{"type": "text", "text": caption}]
+                for photo_bytes in photos_bytes:
+                    base64_image = base64.b64encode(photo_bytes).decode('utf-8')
+                    content.append({
                         "type": "image_url",
                         "image_url": {
                             "url": f"data:image/jpeg;base64,{base64_image}"
                         }
-                    }
+                    })
+            
+                math_instruction = "ВАЖНО: Никогда не используй LaTeX (\\[, \\], $, $$, \\frac, \\sqrt и т.д.). Пиши формулы только простым текстом с Unicode: √ для корня, ² ³ для степеней, × для умножения, ÷ для деления, ≈ для приблизительно равно. Пример правильного ответа: v = √(50² + 15²) = √2725 ≈ 52.2 м/с"
+                system_content = f"{role}\n\n{math_instruction}"
+                messages = [
+                    {"role": "system", "content": system_content},
+                    {"role": "user", "content": content}
                 ]
-            }
-        ]
-        
-        response = openai_client.chat.completions.create(
-            model="gpt-4o",
-            messages=messages,
-            max_tokens=2000
-        )
-        answer = response.choices[0].message.content
+            
+                response = await run_llm(
+                    openai_client.chat.completions.create,
+                    model="gpt-4o",
+                    messages=messages,
+                    max_tokens=2000
+                )
+                answer = response.choices[0].message.content
+                vision_cache.put(cache_key, answer, estimate_vision_cost(response.usage))
         
-        if len(answer) > 4000:
-            for i in range(0, len(answer), 4000):
-                chunk = answer[i:i+4000]
-                if chunk:
-                    await update.message.reply_text(chunk)
-        else:
-            await update.message.reply_text(answer)
+            if len(answer) > 4000:
+                for i in range(0, len(answer), 4000):
+                    chunk = answer[i:i+4000]
+                    if chunk:
+                        await message.reply_text(chunk)
+            else:
+                await message.reply_text(answer)
         
-        history.append({"role": "user", "content": f"[Фото] {caption}"})
-        history.append({"role": "assistant", "content": answer})
-        history = history[-20:]
-        if free_requests > 0:
-            free_requests -= 1
-        save_user_context(user_id, role, history, free_requests, subscription_end)
+            photo_tag = f"[Фото ×{count}]" if count > 1 else "[Фото]"
+            history.append({"role": "user", "content": f"{photo_tag} {caption}"})
+            history.append({"role": "assistant", "content": answer})
+            history = history[-20:]
+            save_user_context(user_id, role, history)
         
-    except Exception as e:
-        error_msg = str(e)
-        logging.error(f"Photo processing error: {e}")
-        if "insufficient_quota" in error_msg or "429" in error_msg:
-            await update.message.reply_text(
-                "🤖 Извините, сейчас я перегружен. Попробуйте позже или обратитесь к @adam0v_0.",
-                reply_markup=get_main_menu()
-            )
-        else:
-            await update.message.reply_text(
-                "Произошла ошибка при обработке фото. Попробуйте еще раз.",
-                reply_markup=get_main_menu()
-            )
+        except Exception as e:
+            error_msg = str(e)
+            logging.error("Photo processing error: %s", e)
+            if "insufficient_quota" in error_msg or "429" in error_msg:
+                await message.reply_text(
+                    "🤖 Извините, сейчас я перегружен. Попробуйте позже или обратитесь к @adam0v_0.",
+                    reply_markup=get_main_menu()
+                )
+            else:
+                await message.reply_text(
+                    "Произошла ошибка при обработке фото. Попробуйте еще раз.",
+                    reply_markup=get_main_menu()
+                )
 
 # --- Генерация картинок ---
 async def generate_image(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    user_id = str(update.message.from_user.id)
-    _, _, free_requests, subscription_end = get_user_context(user_id)
-    if not has_access(user_id):
-        await update.message.reply_text("Первые 10 сообщений закончились. Используй оплату для доступа.")
+    if not await check_flood(update):
         return
+    user_id = str(update.message.from_user.id)
+    async with user_lock(user_id):
+        _, _, free_requests, subscription_end = get_user_context(user_id)
+        if not has_access(user_id):
+            await update.message.reply_text("Первые 10 сообщений закончились. Используй оплату для доступа.")
+            return
 
-    prompt = " ".join(context.args)
-    if not prompt:
-        await update.message.reply_text("Напиши текст после команды /image")
-        return
+        prompt = " ".join(context.args)
+        if not prompt:
+            await update.message.reply_text("Напиши текст после команды /image")
+            return
 
-    try:
-        response = openai_client.images.generate(prompt=prompt, n=1, size="512x512")
-        image_url = response.data[0].url
-        image_data = requests.get(image_url).content
-        await update.message.reply_photo(photo=BytesIO(image_data))
-        role, history, free_requests, subscription_end = get_user_context(user_id)
-        if free_requests > 0:
-            free_requests -= 1
-        save_user_context(user_id, role, history, free_requests, subscription_end)
-    except Exception as e:
-        error_msg = str(e)
-        if "insufficient_quota" in error_msg or "429" in error_msg:
-            await update.message.reply_text(
-                "🤖 Извините, сейчас у меня закончились ресурсы для генерации изображений. "
-                "Пожалуйста, попробуйте позже или обратитесь к администратору @adam0v_0.",
-                reply_markup=get_main_menu()
-            )
+        try:
+            response = await run_llm(openai_client.images.generate, prompt=prompt, n=1, size="512x512")
+            image_url = response.data[0].url
+            async with http_session.get(image_url) as image_response:
+                image_data = await image_response.read()
+            await update.message.reply_photo(photo=BytesIO(image_data))
+            role, history, free_requests, subscription_end = get_user_context(user_id)
+            save_user_context(user_id, role, history)
+        except Exception as e:
+            error_msg = str(e)
+            if "insufficient_quota" in error_msg or "429" in error_msg:
+                await update.message.reply_text(
+                    "🤖 Извините, сейчас у меня закончились ресурсы для генерации изображений. "
+                    "Пожалуйста, попробуйте позже или обратитесь к администратору @adam0v_0.",
+                    reply_markup=get_main_menu()
+                )
+            else:
+                await update.message.reply_text(
+                    "Произошла ошибка при генерации картинки. Попробуйте еще раз позже.",
+                    reply_markup=get_main_menu()
+                )
+
+# --- Напоминания о подписке ---
+class SubscriptionScheduler:
+    """
+    Куча событий (время, пользователь, тип, окончание подписки) для напоминаний
+    «подписка закончится через N дней» и «подписка закончилась».
+    Загружается один раз по индексу на subscription_end, дальше обновляется
+    точечно при каждом изменении окончания подписки. Устаревшие события
+    не удаляются из кучи, а отбрасываются при извлечении.
+    """
+
+    def __init__(self, db_conn):
+        self.db_conn = db_conn
+        self.heap = []
+        self.ends = {}  # user_id -> актуальное окончание подписки
+        self.wakeup = asyncio.Event()
+
+    def _schedule(self, user_id, subscription_end):
+        self.ends[user_id] = subscription_end
+        heapq.heappush(self.heap, (subscription_end - REMINDER_DAYS_BEFORE * 24 * 3600, user_id, "reminder", subscription_end))
+        heapq.heappush(self.heap, (subscription_end, user_id, "expired", subscription_end))
+        self.wakeup.set()
+
+    def load(self):
+        db_cursor = self.db_conn.cursor()
+        db_cursor.execute(
+            "SELECT user_id, subscription_end FROM contexts WHERE subscription_end > ?",
+            (time.time() - EXPIRED_NOTICE_GRACE,)
+        )
+        for user_id, subscription_end in db_cursor.fetchall():
+            self._schedule(user_id, subscription_end)
+
+    def update(self, user_id, subscription_end):
+        if self.ends.get(user_id) == subscription_end:
+            return
+        if subscription_end > time.time():
+            self._schedule(user_id, subscription_end)
         else:
-            await update.message.reply_text(
-                "Произошла ошибка при генерации картинки. Попробуйте еще раз позже.",
-                reply_markup=get_main_menu()
-            )
+            self.ends.pop(user_id, None)
+
+    def _mark_sent(self, user_id, kind, subscription_end):
+        """Фиксирует уведомление; False, если оно уже отправлялось (например, до перезапуска)."""
+        db_cursor = self.db_conn.cursor()
+        db_cursor.execute(
+            "INSERT OR IGNORE INTO subscription_notices VALUES (?, ?, ?, ?)",
+            (user_id, kind, subscription_end, time.time())
+        )
+        self.db_conn.commit()
+        return db_cursor.rowcount > 0
+
+    async def _notify(self, bot, due):
+        for i in range(0, len(due), NOTIFY_BATCH_SIZE):
+            if i:
+                await asyncio.sleep(NOTIFY_BATCH_PAUSE)
+            for user_id, kind, subscription_end in due[i:i + NOTIFY_BATCH_SIZE]:
+                if kind == "reminder" and subscription_end <= time.time():
+                    continue
+                if not self._mark_sent(user_id, kind, subscription_end):
+                    continue
+                if kind == "reminder":
+                    end_text = time.strftime('%d.%m.%Y %H:%M', time.localtime(subscription_end))
+                    text = f"⏳ Ваша подписка закончится {end_text}. Продлить ее можно командой /subscribe"
+                else:
+                    text = "⌛ Ваша подписка закончилась. Чтобы продолжить пользоваться ботом, оформите новую: /subscribe"
+                try:
+                    await bot.send_message(chat_id=int(user_id), text=text)
+                except Exception as e:
+                    logging.error("Failed to send subscription %s to %s: %s", kind, user_id, e)
+
+    async def run(self, bot):
+        while True:
+            try:
+                now = time.time()
+                due = []
+                while self.heap and self.heap[0][0] <= now:
+                    _, user_id, kind, subscription_end = heapq.heappop(self.heap)
+                    if self.ends.get(user_id) != subscription_end:
+                        continue
+                    due.append((user_id, kind, subscription_end))
+                    if kind == "expired":
+                        self.ends.pop(user_id, None)
+                
+                if due:
+                    logging.info("Subscription scheduler: sending %s notifications", len(due))
+                    await self._notify(bot, due)
+                    continue
+                
+                self.wakeup.clear()
+                timeout = self.heap[0][0] - now if self.heap else None
+                try:
+                    await asyncio.wait_for(self.wakeup.wait(), timeout)
+                except asyncio.TimeoutError:
+                    pass
+            except Exception as e:
+                logging.error("Subscription scheduler error: %s", e)
+                await asyncio.sleep(60)
 
 # --- Фоновая проверка платежей ---
-async def check_pending_payments(bot):
+async def check_pending_payments(tenant):
+    current_tenant.set(tenant)
     while True:
         try:
             await asyncio.sleep(30)
@@ -740,8 +1684,8 @@ async def check_pending_payments(bot):
             if not YOOKASSA_AVAILABLE:
                 continue
             
-            check_conn = sqlite3.connect("user_contexts.db")
-            check_cursor = check_conn.cursor()
+            # Основное соединение бота, а не отдельное: иначе каждая запись перезапускала бы идущий бэкап
+            check_cursor = tenant.conn.cursor()
             
             check_cursor.execute(
                 "SELECT payment_id, user_id FROM yookassa_payments WHERE status = 'pending'"
@@ -750,69 +1694,259 @@ async def check_pending_payments(bot):
             
             for payment_id, user_id in pending:
                 try:
-                    payment = Payment.find_one(payment_id)
+                    payment = await run_yookassa(Payment.find_one, payment_id)
                     
                     if payment.status == "succeeded":
                         months = int(payment.metadata.get("months", 1)) if payment.metadata else 1
                         days = months * 30
                         
-                        check_cursor.execute(
-                            "SELECT role, history, free_requests, subscription_end FROM contexts WHERE user_id=?",
-                            (user_id,)
-                        )
-                        row = check_cursor.fetchone()
-                        
-                        if row:
-                            role, history, free_requests, current_sub_end = row
-                        else:
-                            role, history, free_requests, current_sub_end = "Ты ассистент.", "[]", 10, 0
-                        
-                        if current_sub_end > time.time():
-                            subscription_end = current_sub_end + days * 24 * 3600
-                        else:
-                            subscription_end = time.time() + days * 24 * 3600
-                        
-                        check_cursor.execute(
-                            "INSERT OR REPLACE INTO contexts VALUES (?,?,?,?,?)",
-                            (user_id, role, history, free_requests, subscription_end)
-                        )
+                        extend_subscription(check_cursor, user_id, days)
                         check_cursor.execute(
                             "UPDATE yookassa_payments SET status = 'succeeded' WHERE payment_id = ?",
                             (payment_id,)
                         )
-                        check_conn.commit()
+                        tenant.conn.commit()
                         
-                        logging.info(f"Payment check: Subscription activated for {user_id} for {days} days")
+                        logging.info("Payment check: Subscription activated for %s for %s days", user_id, days)
                         
                         try:
-                            await bot.send_message(
+                            await tenant.bot.send_message(
                                 chat_id=int(user_id),
                                 text=f"✅ Оплата получена! Подписка активирована на {days} дней."
                             )
                         except Exception as e:
-                            logging.error(f"Failed to notify user {user_id}: {e}")
+                            logging.error("Failed to notify user %s: %s", user_id, e)
                     
                     elif payment.status == "canceled":
                         check_cursor.execute(
                             "UPDATE yookassa_payments SET status = 'canceled' WHERE payment_id = ?",
                             (payment_id,)
                         )
-                        check_conn.commit()
+                        tenant.conn.commit()
                 
                 except Exception as e:
-                    logging.error(f"Error checking payment {payment_id}: {e}")
-            
-            check_conn.close()
+                    logging.error("Error checking payment %s: %s", payment_id, e)
             
         except Exception as e:
-            logging.error(f"Payment check loop error: {e}")
+            logging.error("Payment check loop error: %s", e)
             await asyncio.sleep(60)
 
-# --- Основная функция ---
-async def run_bot():
-    global telegram_bot
+# --- Обслуживание базы ---
+def archive_cold_users_step(db_conn, cutoff):
+    """
+    Переносит историю части неактивных пользователей в contexts_archive.
+    Возвращает (сколько перенесено, остались ли еще кандидаты).
+    """
+    started = time.monotonic()
+    db_cursor = db_conn.cursor()
+    db_cursor.execute(
+        "SELECT user_id, history FROM contexts "
+        "WHERE last_active < ? AND history IS NOT NULL AND history != '[]' LIMIT ?",
+        (cutoff, MAINTENANCE_BATCH)
+    )
+    rows = db_cursor.fetchall()
+    
+    archived = 0
+    for user_id, history in rows:
+        db_cursor.execute(
+            "INSERT OR REPLACE INTO contexts_archive VALUES (?, ?, ?)",
+            (user_id, zlib.compress(history.encode("utf-8")), time.time())
+        )
+        # Пользователь мог написать, пока шел шаг: тогда архивная копия не нужна
+        db_cursor.execute(
+            "UPDATE contexts SET history = NULL WHERE user_id = ? AND last_active < ?",
+            (user_id, cutoff)
+        )
+        if db_cursor.rowcount == 0:
+            db_cursor.execute("DELETE FROM contexts_archive WHERE user_id = ?", (user_id,))
+        else:
+            archived += 1
+        if time.monotonic() - started > MAINTENANCE_STEP_BUDGET:
+            db_conn.commit()
+            return archived, True
     
-    tg_app = ApplicationBuilder().token(TELEGRAM_TOKEN).build()
+    db_conn.commit()
+    return archived, len(rows) == MAINTENANCE_BATCH
+
+def purge_subscription_notices(db_conn):
+    """
+    Удаляет отметки об уведомлениях по подпискам, закончившимся раньше EXPIRED_NOTICE_GRACE:
+    планировщик такие подписки уже не загружает, и повторной отправки не будет.
+    """
+    db_cursor = db_conn.cursor()
+    db_cursor.execute(
+        "DELETE FROM subscription_notices WHERE subscription_end < ?",
+        (time.time() - EXPIRED_NOTICE_GRACE,)
+    )
+    db_conn.commit()
+    return db_cursor.rowcount
+
+def incremental_vacuum_step(db_conn):
+    """Возвращает в ОС до VACUUM_PAGES_PER_STEP свободных страниц. Возвращает остаток свободных страниц."""
+    # execute() делает только один шаг запроса и освобождает одну страницу,
+    # executescript() выполняет прагму до конца
+    db_conn.executescript(f"PRAGMA incremental_vacuum({VACUUM_PAGES_PER_STEP})")
+    db_cursor = db_conn.cursor()
+    db_cursor.execute("PRAGMA freelist_count")
+    return db_cursor.fetchone()[0]
+
+async def run_maintenance(tenant):
+    while True:
+        try:
+            await asyncio.sleep(MAINTENANCE_INTERVAL)
+            
+            # Обслуживание пишет из своего соединения, а такие записи перезапускают
+            # онлайн-бэкап: на время прохода бэкап и экспорт ждут
+            async with tenant.backup_lock:
+                maintenance_conn = sqlite3.connect(tenant.db_path, check_same_thread=False)
+                try:
+                    cutoff = time.time() - ARCHIVE_AFTER_DAYS * 24 * 3600
+                    archived_total = 0
+                    more = True
+                    while more:
+                        archived, more = await asyncio.to_thread(archive_cold_users_step, maintenance_conn, cutoff)
+                        archived_total += archived
+                        await asyncio.sleep(MAINTENANCE_PAUSE)
+                    
+                    purged = await asyncio.to_thread(purge_subscription_notices, maintenance_conn)
+                    
+                    free_pages = await asyncio.to_thread(incremental_vacuum_step, maintenance_conn)
+                    while free_pages > 0:
+                        await asyncio.sleep(MAINTENANCE_PAUSE)
+                        free_pages = await asyncio.to_thread(incremental_vacuum_step, maintenance_conn)
+                finally:
+                    maintenance_conn.close()
+            
+            logging.info(
+                "Maintenance %s: archived history of %s inactive users, purged %s subscription notices",
+                tenant.name, archived_total, purged
+            )
+            
+        except Exception as e:
+            logging.error("Maintenance loop error: %s", e)
+
+# --- Бэкап и экспорт ---
+# Метка времени в именах файлов: 20261019-134920. Маска повторяет ее точно,
+# чтобы ротация бота "main" не задевала файлы бота "main-2"
+STAMP_GLOB = "[0-9]" * 8 + "-" + "[0-9]" * 6
+
+def rotate_backups(pattern):
+    for path in sorted(glob.glob(pattern))[:-BACKUP_KEEP]:
+        os.remove(path)
+
+def backup_database(tenant):
+    """
+    Онлайн-снимок базы через SQLite backup API: по BACKUP_PAGES_PER_STEP страниц
+    с паузой между шагами, затем gzip и ротация. Вызывать из отдельного потока.
+    Источник — основное соединение бота: его собственные записи во время копирования
+    попадают в снимок без перезапуска бэкапа. Запись из другого соединения начинает
+    копирование заново; после перезапуска шаги идут без пауз, чтобы успеть до следующей
+    записи, а после BACKUP_MAX_RESTARTS перезапусков бэкап прерывается.
+    """
+    os.makedirs(BACKUP_DIR, exist_ok=True)
+    stamp = time.strftime('%Y%m%d-%H%M%S')
+    tmp_path = os.path.join(BACKUP_DIR, f"{tenant.name}-{stamp}.db.tmp")
+    backup_path = os.path.join(BACKUP_DIR, f"{tenant.name}-{stamp}.db.gz")
+    
+    progress = {"remaining": None, "restarts": 0}
+    
+    def throttle(status, remaining, total):
+        if progress["remaining"] is not None and remaining > progress["remaining"]:
+            progress["restarts"] += 1
+            if progress["restarts"] > BACKUP_MAX_RESTARTS:
+                raise RuntimeError(f"backup restarted {BACKUP_MAX_RESTARTS} times by concurrent writes")
+        progress["remaining"] = remaining
+        if not progress["restarts"]:
+            time.sleep(BACKUP_STEP_PAUSE)
+    
+    backup_conn = sqlite3.connect(tmp_path)
+    try:
+        tenant.conn.backup(backup_conn, pages=BACKUP_PAGES_PER_STEP, progress=throttle)
+    except Exception:
+        backup_conn.close()
+        os.remove(tmp_path)
+        raise
+    finally:
+        backup_conn.close()
+    
+    try:
+        with open(tmp_path, "rb") as src, gzip.open(backup_path, "wb") as dst:
+            shutil.copyfileobj(src, dst, 1024 * 1024)
+    finally:
+        os.remove(tmp_path)
+    
+    rotate_backups(os.path.join(BACKUP_DIR, f"{tenant.name}-{STAMP_GLOB}.db.gz"))
+    return backup_path
+
+def export_rows(db_conn, query, key_index, out, record_type):
+    """
+    Пишет строки запроса в out как JSONL. Читает пачками по ключу, а не одним курсором,
+    чтобы блокировка чтения не держалась всё время экспорта и не мешала записи.
+    """
+    db_cursor = db_conn.cursor()
+    last_key = ""
+    count = 0
+    while True:
+        db_cursor.execute(query, (last_key, EXPORT_BATCH))
+        columns = [column[0] for column in db_cursor.description]
+        rows = db_cursor.fetchall()
+        for row in rows:
+            record = {"type": record_type, **dict(zip(columns, row))}
+            out.write(json.dumps(record, ensure_ascii=False) + "\n")
+        count += len(rows)
+        if len(rows) < EXPORT_BATCH:
+            return count
+        last_key = rows[-1][key_index]
+        time.sleep(BACKUP_STEP_PAUSE)
+
+def export_users_and_payments(tenant):
+    """Выгружает пользователей и платежи в сжатый JSONL. Вызывать из отдельного потока."""
+    os.makedirs(BACKUP_DIR, exist_ok=True)
+    export_path = os.path.join(BACKUP_DIR, f"{tenant.name}-export-{time.strftime('%Y%m%d-%H%M%S')}.jsonl.gz")
+    
+    export_conn = sqlite3.connect(f"file:{tenant.db_path}?mode=ro", uri=True)
+    try:
+        with gzip.open(export_path, "wt", encoding="utf-8") as out:
+            users = export_rows(
+                export_conn,
+                "SELECT user_id, free_requests, subscription_end, last_active FROM contexts "
+                "WHERE user_id > ? ORDER BY user_id LIMIT ?",
+                0, out, "user"
+            )
+            payments = export_rows(
+                export_conn,
+                "SELECT payment_id, user_id, amount, months, status, created_at FROM yookassa_payments "
+                "WHERE payment_id > ? ORDER BY payment_id LIMIT ?",
+                0, out, "payment"
+            )
+    finally:
+        export_conn.close()
+    
+    rotate_backups(os.path.join(BACKUP_DIR, f"{tenant.name}-export-{STAMP_GLOB}.jsonl.gz"))
+    return export_path, users, payments
+
+async def run_backups(tenant):
+    while True:
+        try:
+            await asyncio.sleep(BACKUP_INTERVAL)
+            async with tenant.backup_lock:
+                backup_path = await asyncio.to_thread(backup_database, tenant)
+            logging.info("Backup %s: snapshot written to %s", tenant.name, backup_path)
+        except Exception as e:
+            logging.error("Backup loop error: %s", e)
+
+# --- Основная функция ---
+def build_application(tenant, request, get_updates_request):
+    tg_app = (
+        ApplicationBuilder()
+        .token(tenant.token)
+        .request(request)
+        .get_updates_request(get_updates_request)
+        .build()
+    )
+    tg_app.bot_data["tenant"] = tenant
+
+    tg_app.add_handler(TypeHandler(Update, bind_update_context), group=-1)
 
     tg_app.add_handler(CommandHandler("start", start))
     tg_app.add_handler(CommandHandler("chat_start", chat_start))
@@ -824,6 +1958,11 @@ async def run_bot():
 
     tg_app.add_handler(CommandHandler("admin_stats", admin_stats))
     tg_app.add_handler(CommandHandler("admin_broadcast", admin_broadcast))
+    # Профилирование идет секундами: не блокируем обработку остальных апдейтов
+    tg_app.add_handler(CommandHandler("admin_profile", admin_profile, block=False))
+    tg_app.add_handler(CommandHandler("admin_stalls", admin_stalls))
+    tg_app.add_handler(CommandHandler("admin_backup", admin_backup, block=False))
+    tg_app.add_handler(CommandHandler("admin_export", admin_export, block=False))
     tg_app.add_handler(CommandHandler("activate_sub", activate_subscription))
     tg_app.add_handler(CommandHandler("deactivate_sub", deactivate_subscription))
 
@@ -839,38 +1978,74 @@ async def run_bot():
     tg_app.add_handler(MessageHandler(filters.PHOTO, handle_photo))
 
     async def error_handler(update: object, context: ContextTypes.DEFAULT_TYPE) -> None:
-        logging.error(f"Exception while handling an update: {context.error}")
+        logging.error("Exception while handling an update: %s", context.error)
         if isinstance(update, Update) and update.message:
             await update.message.reply_text(f"Произошла ошибка: {context.error}")
 
     tg_app.add_error_handler(error_handler)
     
-    telegram_bot = tg_app.bot
+    tenant.bot = tg_app.bot
+    return tg_app
+
+async def run_bot():
+    global tenants, http_session
+    
+    tenants = load_tenants()
+    
+    # Пулы HTTP общие: один для вызовов Bot API всех ботов, один для long polling
+    # (по соединению на бота) и одна aiohttp-сессия для остальных запросов
+    request = SharedHTTPXRequest(connection_pool_size=TELEGRAM_POOL_SIZE)
+    get_updates_request = SharedHTTPXRequest(connection_pool_size=len(tenants))
+    http_session = aiohttp.ClientSession()
+    applications = {
+        name: build_application(tenant, request, get_updates_request)
+        for name, tenant in tenants.items()
+    }
     
     health_app = web.Application()
     health_app.router.add_get('/', handle_health)
     health_app.router.add_post('/yookassa-webhook', handle_yookassa_webhook)
+    health_app.router.add_post('/yookassa-webhook/{tenant}', handle_yookassa_webhook)
     
     runner = web.AppRunner(health_app)
     await runner.setup()
-    site = web.TCPSite(runner, '0.0.0.0', 5000)
+    site = web.TCPSite(runner, '0.0.0.0', PORT)
     await site.start()
-    print("Health check server on port 5000")
-    logging.info("Health check server on port 5000")
+    print(f"Health check server on port {PORT}")
+    logging.info("Health check server on port %s", PORT)
     
-    async with tg_app:
-        await tg_app.start()
-        print("Telegram bot started...")
-        logging.info("Telegram bot started")
-        
-        asyncio.create_task(check_pending_payments(tg_app.bot))
-        print("Payment checker started (every 30 seconds)")
-        logging.info("Payment checker started")
-        
-        await tg_app.updater.start_polling()
-        
-        while True:
-            await asyncio.sleep(3600)
+    try:
+        async with contextlib.AsyncExitStack() as stack:
+            for name, tg_app in applications.items():
+                tenant = tenants[name]
+                await stack.enter_async_context(tg_app)
+                await tg_app.start()
+                print(f"Telegram bot {name} started...")
+                logging.info("Telegram bot %s started", name)
+                
+                asyncio.create_task(check_pending_payments(tenant))
+                logging.info("Payment checker for %s started", name)
+                
+                tenant.subscription_scheduler.load()
+                asyncio.create_task(tenant.subscription_scheduler.run(tenant.bot))
+                logging.info("Subscription scheduler for %s started", name)
+                
+                asyncio.create_task(run_maintenance(tenant))
+                logging.info("Database maintenance for %s started", name)
+                
+                if BACKUP_INTERVAL > 0:
+                    asyncio.create_task(run_backups(tenant))
+                    logging.info("Backups for %s started (every %s seconds)", name, BACKUP_INTERVAL)
+                
+                await tg_app.updater.start_polling()
+            
+            while True:
+                await asyncio.sleep(3600)
+    finally:
+        await http_session.close()
+        await request.close()
+        await get_updates_request.close()
+        await runner.cleanup()
 
 if __name__ == "__main__":
     print("Starting Telegram bot...")